@@ -0,0 +1,257 @@
+import collections
+import contextlib
+import glob
+import os
+import pickle
+import sys
+import threading
+import time
+
+"""
+This file contains a low-overhead sampling profiler used by the --profile option of SOJA and ROJA.
+Each worker process runs its own sampler thread that periodically records the stacks of its threads,
+tagging the main thread's with the phase the worker is currently in (e.g. build, probe, transfer wait,
+write) and the other threads' (e.g. the feeder thread pickling what is put on a Queue) as background.
+Samples of every worker are dumped to a profile directory and merged by the parent into a text
+report and a collapsed-stack file that can be rendered by flamegraph tools.
+"""
+
+SAMPLES_EXTENSION = ".samples"
+
+
+def frame_label(frame, lineno):
+    """Returns a readable label identifying the function of a stack frame.
+
+    Args:
+        frame (frame): The stack frame to label.
+        lineno (int): The line number shown in the label.
+
+    Returns:
+        label (str): The function name with its file and line number.
+    """
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+def thread_cpu_time(thread_id):
+    """Returns the CPU time used by a thread of this process.
+
+    Args:
+        thread_id (int): The identifier of the thread, as returned by threading.get_ident().
+
+    Returns:
+        cpu_time (float): The CPU time in seconds, or None if the platform cannot measure it.
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+def frame_lineno(frame):
+    """Returns the line being executed by a stack frame.
+
+    Frames read from another thread are often paused on the jump closing a loop, which has no line
+    number, in which case the line of the closest preceding instruction is used.
+
+    Args:
+        frame (frame): The stack frame to look up.
+
+    Returns:
+        lineno (int): The line being executed, or the first line of the function if it cannot be found.
+    """
+    if frame.f_lineno is not None:
+        return frame.f_lineno
+    result = frame.f_code.co_firstlineno
+    for start, end, lineno in frame.f_code.co_lines():
+        if start > frame.f_lasti:
+            break
+        if lineno is not None:
+            result = lineno
+    return result
+
+
+class Sampler:
+    """Samples the stacks of every thread of the process, tagging the samples of the thread that created it
+    with the current phase and those of the other threads as background.
+
+    Background threads are only sampled while they use CPU, so that idle ones (e.g. a feeder thread with
+    nothing to send) do not drown the rest. Platforms without per-thread CPU clocks sample them always.
+
+    Each sample is keyed by its phase, the labels of the functions on the stack from the outermost to the
+    innermost, and the label of the line being executed by the innermost function.
+
+    The phase is only a label, so it can be switched with phase() whether or not sampling has been started.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        Args:
+            interval (float): The number of seconds between two samples.
+        """
+        self.interval = interval
+        self.current_phase = "other"
+        self.counts = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Tag the samples taken while the block is running with the given phase."""
+        previous_phase = self.current_phase
+        self.current_phase = name
+        try:
+            yield
+        finally:
+            self.current_phase = previous_phase
+
+    def start(self):
+        """Start sampling in a background daemon thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the background thread to finish."""
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        sampler_thread_id = threading.get_ident()
+        cpu_times = {}
+        while not self._stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_thread_id:
+                    continue
+                if thread_id != self._thread_id:
+                    # a thread using less than a tenth of a CPU since the previous sample is considered idle
+                    cpu_time = thread_cpu_time(thread_id)
+                    previous_cpu_time = cpu_times.get(thread_id)
+                    cpu_times[thread_id] = cpu_time
+                    if previous_cpu_time is not None and cpu_time - previous_cpu_time < self.interval / 10:
+                        continue
+                # the line being executed exposes line-level hot spots, including calls into C functions
+                # that have no frame of their own
+                line = frame_label(frame, frame_lineno(frame))
+                functions = []
+                while frame is not None:
+                    functions.append(frame_label(frame, frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                if thread_id == self._thread_id:
+                    phase = self.current_phase
+                else:
+                    phase = "background"
+                    functions.append(f"[{thread_names.get(thread_id, thread_id)}]")
+                # stacks are stored from the outermost to the innermost frame
+                self.counts[(phase, tuple(reversed(functions)), line)] += 1
+
+    def dump(self, profile_dir, name):
+        """Write the samples to the profile directory, in a file unique to the current process.
+
+        Args:
+            profile_dir (str): The directory where the samples of every worker are collected.
+            name (str): The name identifying the kind of worker in the merged report.
+
+        Returns:
+            None
+        """
+        path = os.path.join(profile_dir, f"{name}-{os.getpid()}{SAMPLES_EXTENSION}")
+        with open(path, "wb") as f:
+            pickle.dump(
+                {"worker": f"{name}-{os.getpid()}", "interval": self.interval, "counts": self.counts},
+                f,
+            )
+
+
+def exclude_samplers(stats):
+    """Leave the allocations made by samplers out of tracemalloc statistics grouped by line.
+
+    Args:
+        stats (list): The tracemalloc statistics of a snapshot, grouped by line.
+
+    Returns:
+        stats (list): The statistics without the lines of this file.
+    """
+    return [stat for stat in stats if stat.traceback[0].filename != __file__]
+
+
+def prepare_profile_dir(profile_dir):
+    """Create the profile directory and remove the samples left over by a previous run.
+
+    Args:
+        profile_dir (str): The directory where the samples of every worker are collected.
+
+    Returns:
+        None
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(profile_dir, "*" + SAMPLES_EXTENSION)):
+        os.remove(path)
+
+
+def merge_profiles(profile_dir, top=15):
+    """Merge the samples of every worker into a text report and a collapsed-stack file.
+
+    The collapsed-stack file contains one line per distinct stack, with the phase as the root frame and
+    the line being executed as the leaf, and can be passed directly to flamegraph.pl or speedscope.
+    In the report, the self column counts the samples executing a line and the total column counts the
+    samples anywhere in the function of that line, including the functions it calls.
+
+    Args:
+        profile_dir (str): The directory where the samples of every worker are collected.
+        top (int): The number of functions listed per phase in the report.
+
+    Returns:
+        tuple: A tuple containing the paths of the report and of the collapsed-stack file.
+    """
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, "*" + SAMPLES_EXTENSION))):
+        with open(path, "rb") as f:
+            profiles.append(pickle.load(f))
+
+    merged = collections.Counter()
+    for profile in profiles:
+        merged.update(profile["counts"])
+    interval = profiles[0]["interval"] if profiles else 0
+
+    collapsed_path = os.path.join(profile_dir, "profile.collapsed")
+    with open(collapsed_path, "w") as f:
+        for (phase, functions, line), count in sorted(merged.items()):
+            f.write(f"{';'.join((phase,) + functions[:-1] + (line,))} {count}\n")
+
+    lines = [f"Sampling interval: {interval * 1000:.1f} ms", "", "Samples per worker and phase:"]
+    phases = sorted({phase for phase, functions, line in merged})
+    for profile in profiles:
+        per_phase = collections.Counter()
+        for (phase, functions, line), count in profile["counts"].items():
+            per_phase[phase] += count
+        summary = ", ".join(
+            f"{phase} {per_phase[phase]} (~{per_phase[phase] * interval:.2f}s)"
+            for phase in phases
+            if per_phase[phase]
+        )
+        lines.append(f"  {profile['worker']}: {summary}")
+
+    for phase in phases:
+        self_counts = collections.Counter()
+        line_functions = {}
+        total_counts = collections.Counter()
+        for (sample_phase, functions, line), count in merged.items():
+            if sample_phase != phase:
+                continue
+            self_counts[line] += count
+            line_functions[line] = functions[-1]
+            # count each function once per stack, even when it is recursive
+            for function in set(functions):
+                total_counts[function] += count
+        lines += ["", f"Phase '{phase}' ({sum(self_counts.values())} samples):"]
+        lines.append(f"  {'self':>8} {'total':>8}  line being executed")
+        for line, count in self_counts.most_common(top):
+            lines.append(f"  {count:>8} {total_counts[line_functions[line]]:>8}  {line}")
+
+    report_path = os.path.join(profile_dir, "report.txt")
+    with open(report_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return report_path, collapsed_path
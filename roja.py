@@ -1,9 +1,12 @@
 import argparse
 import csv
 import multiprocessing as mp
+import multiprocessing.util
 import time
 import tracemalloc
 
+from profiler import Sampler, exclude_samplers, merge_profiles, prepare_profile_dir
+
 """
 This file contains the implementation of ROJA with slight adaptation for benchmarking purposes.
 The algorithm had been referenced from FIT3182: Parallel_outer_join workbook. Changes include:
@@ -11,6 +14,8 @@ The algorithm had been referenced from FIT3182: Parallel_outer_join workbook. Ch
 - Adding function to cater for 1 to many outer join relationship
 - Modify hash function to use the first element of the join attribute
 - Addition of ArgumentParser to allow for command line arguments
+- Addition of a --profile option sampling each worker process
+- Closing the pool once the results are written
 """
 
 
@@ -61,8 +66,14 @@ def H(r):
     # return sum(digits)
 
 
-def outer_join(L, R, join="left"):
-    """outer join using Hash-based join algorithm"""
+def outer_join(L, R, join="left", sampler=None):
+    """outer join using Hash-based join algorithm
+
+    sampler -- sampler of the worker tagging the build and probe phases, None when not profiling
+    """
+    # phases are only labels unless the sampler is started
+    if sampler is None:
+        sampler = Sampler()
 
     # swaps the input relations L & R to perform a right join instead of a left join
     if join == "right":
@@ -73,97 +84,169 @@ def outer_join(L, R, join="left"):
         #  creates a dictionary
         h_dic = {}
         # store the records in R hashed by their join attribute using the hash function
-        for r in R:
-            h_r = H(r)
-            if h_r in h_dic.keys():
-                h_dic[h_r].add(r)
-            else:
-                h_dic[h_r] = {r}
+        with sampler.phase("build"):
+            for r in R:
+                h_r = H(r)
+                if h_r in h_dic.keys():
+                    h_dic[h_r].add(r)
+                else:
+                    h_dic[h_r] = {r}
 
         result = []
-        for l in L:
-            # hashes its join attribute using H
-            h_l = H(l)
-            #  If a match is found
-            if h_l in h_dic.keys():
-                for item in h_dic[h_l]:
-                    if item[0] == l[0]:  # prevent collision
-                        # appends a three-element list to the result list
-                        result.append(l[0] + item[1:])
+        with sampler.phase("probe"):
+            for l in L:
+                # hashes its join attribute using H
+                h_l = H(l)
+                #  If a match is found
+                if h_l in h_dic.keys():
+                    for item in h_dic[h_l]:
+                        if item[0] == l[0]:  # prevent collision
+                            # appends a three-element list to the result list
+                            result.append(l[0] + item[1:])
         return result
 
     elif join in ["left", "right"]:
         #  creates a dictionary
         h_dic = {}
-        for r in R:
-            h_r = H(r)
-            if h_r in h_dic.keys():
-                h_dic[h_r].add(r)
-            else:
-                h_dic[h_r] = {r}
+        with sampler.phase("build"):
+            for r in R:
+                h_r = H(r)
+                if h_r in h_dic.keys():
+                    h_dic[h_r].add(r)
+                else:
+                    h_dic[h_r] = {r}
 
         result = []
 
         # it iterates over each record in L (for a left join) or R (for a right join)
         # we already swapped
-        for l in L:
-            isFound = False  # to check whether there is a match found.
-            h_l = H(l)
-
-            if h_l in h_dic.keys():
-                for item in h_dic[h_l]:
-                    if item[0] == l[0]:  # want to get exact ID match
-                        result.append(l + item[1:])
-                        isFound = True
-            # If no match is found
-            # The difference of inner join
-            if not isFound:
-                result.append(l[1:] + tuple(["None"]))
+        with sampler.phase("probe"):
+            for l in L:
+                isFound = False  # to check whether there is a match found.
+                h_l = H(l)
+
+                if h_l in h_dic.keys():
+                    for item in h_dic[h_l]:
+                        if item[0] == l[0]:  # want to get exact ID match
+                            result.append(l + item[1:])
+                            isFound = True
+                # If no match is found
+                # The difference of inner join
+                if not isFound:
+                    result.append(l[1:] + tuple(["None"]))
         return result
 
     else:
         raise AttributeError("join should be in {left, right, inner}.")
 
 
-def roja(L, R, n, output_file_path):
+# sampler of the current pool worker, set by start_worker_sampler
+worker_sampler = None
+
+
+def start_worker_sampler(profile_dir):
+    """start sampling a pool worker until it exits
+
+    profile_dir -- directory where the samples of the worker are written
+    """
+    global worker_sampler
+    worker_sampler = Sampler()
+    # outside of a task, the worker is waiting for the next one or sending back a result
+    worker_sampler.current_phase = "transfer wait"
+    worker_sampler.start()
+    # pool workers run the multiprocessing finalizers when they exit after the pool is closed
+    multiprocessing.util.Finalize(
+        worker_sampler, stop_worker_sampler, args=(profile_dir,), exitpriority=10
+    )
+
+
+def stop_worker_sampler(profile_dir):
+    """stop sampling a pool worker and write its samples
+
+    profile_dir -- directory where the samples of the worker are written
+    """
+    worker_sampler.stop()
+    worker_sampler.dump(profile_dir, "roja-worker")
+
+
+def profiled_outer_join(L, R):
+    """outer join of a partition tagging the phases of the sampled pool worker running it
+
+    L -- a list of records from Left relation
+    R -- a list of records from Right relation
+    """
+    return outer_join(L, R, sampler=worker_sampler)
+
+
+def roja(L, R, n, output_file_path, profile_dir=None):
     """left outer join using ROJA
 
     L -- a list of records from Left relation
     R -- a list of records from Right relation
     n -- number of partitions/processors
+    profile_dir -- directory where the profile samples are written, None to disable profiling
 
     """
-    # 1st step = distribution using hash partitioning
+    if profile_dir:
+        prepare_profile_dir(profile_dir)
+
     tracemalloc.start()
     start_time = time.perf_counter()
 
-    l_dis = hash_distribution(L, n)
-    r_dis = hash_distribution(R, n)
+    # the pool is created first so that its workers are forked before the sampler thread is started,
+    # as forking a process running threads can deadlock
+    if profile_dir:
+        pool = mp.Pool(n, initializer=start_worker_sampler, initargs=(profile_dir,))
+    else:
+        pool = mp.Pool(n)
+
+    # phases are only labels unless the sampler is started
+    sampler = Sampler()
+    if profile_dir:
+        sampler.start()
+
+    # 1st step = distribution using hash partitioning
+    with sampler.phase("partition"):
+        l_dis = hash_distribution(L, n)
+        r_dis = hash_distribution(R, n)
 
     # Apply left outer join for each processor
-    pool = mp.Pool(n)
     results = []
 
     # for each paritition
     for i in l_dis.keys():
         # apply a join on each processor
-        result = pool.apply_async(outer_join, [l_dis[i], r_dis[i]])
+        if profile_dir:
+            result = pool.apply_async(profiled_outer_join, [l_dis[i], r_dis[i]])
+        else:
+            result = pool.apply_async(outer_join, [l_dis[i], r_dis[i]])
         results.append(result)
 
     # Get the results
     output = []
-    for x in results:
-        output.extend(x.get())
+    with sampler.phase("transfer wait"):
+        for x in results:
+            output.extend(x.get())
 
-    with open(output_file_path, "w") as f:
-        csv_writer = csv.writer(f)
-        csv_writer.writerows(output)
+    with sampler.phase("write"):
+        with open(output_file_path, "w") as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerows(output)
 
     elapsed_time = time.perf_counter() - start_time
+
+    # let the workers exit, which writes their samples when profiling
+    pool.close()
+    pool.join()
+
     snapshot = tracemalloc.take_snapshot()
-    top_stats = snapshot.statistics("lineno")
+    top_stats = exclude_samplers(snapshot.statistics("lineno"))
     total_memory = sum(stat.size for stat in top_stats)
 
+    if profile_dir:
+        sampler.stop()
+        sampler.dump(profile_dir, "roja-main")
+
     return elapsed_time, total_memory
 
 
@@ -198,10 +281,24 @@ if __name__ == "__main__":
         required=False,
         default="output-roja.csv",
     )
+    parser.add_argument(
+        "--profile",
+        help="Profile each worker process and write the merged report and collapsed stacks to this directory",
+        required=False,
+        nargs="?",
+        const="profile-roja",
+        metavar="DIR",
+    )
     args = parser.parse_args()
     R, S = read_csv(args.R_file), read_csv(args.S_file)
 
-    elapsed_time, memory_usage = roja(R, S, args.concurrency_count, args.output_file)
+    elapsed_time, memory_usage = roja(
+        R, S, args.concurrency_count, args.output_file, args.profile
+    )
     print(f"Memory usage: {memory_usage / 1024 / 1024:.2f} MB")
     print(f"Execution time: {elapsed_time:.2f} seconds")
+    if args.profile:
+        report_path, collapsed_path = merge_profiles(args.profile)
+        print(f"Profile report: {report_path}")
+        print(f"Collapsed stacks: {collapsed_path}")
     print("-------------------------")
@@ -1,10 +1,14 @@
 import argparse
 import csv
 import multiprocessing as mp
+import os
+import pickle
 import sys
 import time
 import tracemalloc
 
+from profiler import Sampler, exclude_samplers, merge_profiles, prepare_profile_dir
+
 
 def hash(element):
     """Returns the value of the first element of a given input.
@@ -101,7 +105,15 @@ def roundrobin_partition(data, number_of_processor):
     return global_partitions
 
 
-def worker(input_queue, next_queue, max_iteration, output_file_path):
+def worker(
+    input_queue,
+    next_queue,
+    max_iteration,
+    output_file_path,
+    profile_dir=None,
+    partition=None,
+    partition_state_path=None,
+):
     """Perform iterative processing of data (outer joins) in a worker.
 
     Args:
@@ -109,6 +121,10 @@ def worker(input_queue, next_queue, max_iteration, output_file_path):
         next_queue (Queue): The next queue to which processed data is passed for further processing.
         max_iteration (int): The maximum number of iterations to perform.
         output_file_path (str): The file path of the output file where temporary and dangling results are written.
+        profile_dir (str): The directory where the worker's profile samples are written, None to disable profiling.
+        partition (int): The index of the partition of R and S the worker started with.
+        partition_state_path (str): The path prefix of the file where the worker's S hash table and dangling
+            tuples are written once done, None to skip it.
 
     Returns:
         None
@@ -117,39 +133,67 @@ def worker(input_queue, next_queue, max_iteration, output_file_path):
     S_table = None
     S_len = 0
 
+    # phases are only labels unless the sampler is started
+    sampler = Sampler()
+    if profile_dir:
+        sampler.start()
+
     # create csv writer to write temporary data
     output_file = open(output_file_path, "a")
     csv_writer = csv.writer(output_file)
 
     while True:
         # get() is blocking until there is data in the queue
-        R, S, dangling_tuples = input_queue.get()
+        with sampler.phase("transfer wait"):
+            R, S, dangling_tuples = input_queue.get()
         if not S_table:
             # create hash table only in the first iteration
-            S_table = create_hash_table(S)
-            S_len = len(S[0])
+            with sampler.phase("build"):
+                S_table = create_hash_table(S)
+                S_len = len(S[0])
 
         # stop when worker has finish processing all data
         # and write the remaining dangling tuples to file
         if iteration == max_iteration:
             dangling = []
-            for i in dangling_tuples:
-                res = R[i] + tuple([None] * (S_len - 1))
-                csv_writer.writerow(res)
+            with sampler.phase("write"):
+                for i in dangling_tuples:
+                    res = R[i] + tuple([None] * (S_len - 1))
+                    csv_writer.writerow(res)
             break
 
         # process the current R and S
-        result, updated_dangling_tuples = process(R, S_table, dangling_tuples)
+        with sampler.phase("probe"):
+            result, updated_dangling_tuples = process(R, S_table, dangling_tuples)
         # write inner join result to file for current iteration
-        csv_writer.writerows(result)
+        with sampler.phase("write"):
+            csv_writer.writerows(result)
         # transfer R to the next worker with updated dangling tuples
-        next_queue.put((R, None, updated_dangling_tuples))
+        # R is pickled by the queue's feeder thread after put() returns, so it is sampled as background
+        with sampler.phase("transfer wait"):
+            next_queue.put((R, None, updated_dangling_tuples))
         iteration += 1
 
     output_file.close()  # close filet to prevent memory leak
 
+    # R is back at its home worker, so the dangling tuples index the worker's own R partition
+    if partition_state_path:
+        with open(f"{partition_state_path}.{partition}", "wb") as f:
+            pickle.dump((S_table, dangling_tuples), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    if profile_dir:
+        sampler.stop()
+        sampler.dump(profile_dir, "soja-worker")
 
-def soja(R, S, number_of_processor, output_file_path):
+
+def soja(
+    R,
+    S,
+    number_of_processor,
+    output_file_path,
+    profile_dir=None,
+    partition_state_path=None,
+):
     """Perform a distributed outer join using the SOJA algorithm.
 
     Args:
@@ -157,10 +201,16 @@ def soja(R, S, number_of_processor, output_file_path):
         S (list): The list of elements (table S) to process.
         number_of_processor (int): The number of processors to partition the data into and for parallel processing.
         output_file_path (str): The file path of the output file where temporary and dangling results are written.
+        profile_dir (str): The directory where each worker's profile samples are written, None to disable profiling.
+        partition_state_path (str): The path prefix of the files where each worker writes its S hash table
+            and dangling tuples once done, suffixed by the partition index, None to skip it.
 
     Returns:
         tuple: A tuple containing the elapsed time (in seconds) and the total memory used (in bytes).
     """
+    if profile_dir:
+        prepare_profile_dir(profile_dir)
+
     # prerequisite that R and S are partioned equally
     # this is used for DEMO purpose only as in the ideal world, data had already been partitoned equally
     R_partitions = roundrobin_partition(R, number_of_processor)
@@ -187,6 +237,9 @@ def soja(R, S, number_of_processor, output_file_path):
                 process_queues[next_node],
                 number_of_processor,
                 output_file_path,
+                profile_dir,
+                i,
+                partition_state_path,
             ),
         )
         process_list.append(p)
@@ -195,28 +248,288 @@ def soja(R, S, number_of_processor, output_file_path):
     for process in process_list:
         process.start()
 
-    # initialize each worker's queue with corresponding R and S partitions and the dangling tuple set
-    for i, q in enumerate(process_queues):
-        q.put(
-            (
-                R_partitions[i],
-                S_partitions[i],
-                set([i for i in range(len(R_partitions[i]))]),
+    # phases are only labels unless the sampler is started
+    # it is only started once the workers are forked, as forking a process running threads can deadlock
+    sampler = Sampler()
+    if profile_dir:
+        sampler.start()
+
+    with sampler.phase("transfer wait"):
+        # initialize each worker's queue with corresponding R and S partitions and the dangling tuple set
+        for i, q in enumerate(process_queues):
+            q.put(
+                (
+                    R_partitions[i],
+                    S_partitions[i],
+                    set([i for i in range(len(R_partitions[i]))]),
+                )
             )
-        )
 
-    # wait for all processes to finish
-    for p in process_list:
-        p.join()
+        # wait for all processes to finish
+        for p in process_list:
+            p.join()
 
     # stop timer and memory profiler
     # calculate elapsed time and total memory used
     elapsed_time = time.perf_counter() - start_time
 
     snapshot = tracemalloc.take_snapshot()
-    top_stats = snapshot.statistics("lineno")
+    top_stats = exclude_samplers(snapshot.statistics("lineno"))
+
+    total_memory = sum(stat.size for stat in top_stats)
+
+    if profile_dir:
+        sampler.stop()
+        sampler.dump(profile_dir, "soja-main")
+
+    return elapsed_time, total_memory
+
+
+def build_state(R, S, number_of_processor, partition_state_path):
+    """Build the state of an incremental join from the partitions left by a full SOJA run.
+
+    Args:
+        R (list): The list of elements (table R) that was joined.
+        S (list): The list of elements (table S) that was joined.
+        number_of_processor (int): The number of processors of the run.
+        partition_state_path (str): The path prefix of the files where each worker wrote its partition state.
+
+    Returns:
+        dict: The incremental join state, holding the R rows with a hash index of their positions,
+            the hash table of each S partition, the number of S rows seen and the indices of dangling R rows.
+    """
+    R_index = {}
+    for i, element in enumerate(R):
+        R_index.setdefault(hash(element), []).append(i)
+
+    S_tables = []
+    dangling_tuples = set()
+    for partition in range(number_of_processor):
+        with open(f"{partition_state_path}.{partition}", "rb") as f:
+            S_table, partition_dangling_tuples = pickle.load(f)
+        os.remove(f"{partition_state_path}.{partition}")
+        S_tables.append(S_table)
+        # round robin placed the row at global index i at position i // n of partition i % n
+        for i in partition_dangling_tuples:
+            dangling_tuples.add(i * number_of_processor + partition)
+
+    return {
+        "R": list(R),
+        "R_index": R_index,
+        "S_tables": S_tables,
+        "S_count": len(S),
+        "S_len": len(S[0]),
+        "dangling_tuples": dangling_tuples,
+    }
+
+
+def load_state(state_file_path):
+    """Load the state of a previous incremental run.
+
+    Args:
+        state_file_path (str): The path to the pickled state of the previous run.
+
+    Returns:
+        dict: The incremental join state.
+    """
+    with open(state_file_path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_state(state, state_file_path):
+    """Persist the incremental join state, replacing the previous one atomically.
+
+    Args:
+        state (dict): The incremental join state.
+        state_file_path (str): The path to write the pickled state to.
+
+    Returns:
+        None
+    """
+    temp_file_path = state_file_path + ".tmp"
+    with open(temp_file_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_path, state_file_path)
+
+
+def read_appended_csv(filename, offset, last_line):
+    """Read the rows appended to a CSV file after a given byte offset.
+
+    The line ending at the offset must still be the last line read by the previous run, so that a file
+    that was rewritten rather than appended to is rejected. Only complete lines are read.
+
+    Args:
+        filename (str): The path to the CSV file.
+        offset (int): The byte offset up to which the file was read, 0 to read the whole file.
+        last_line (bytes): The last line read by the previous run, including its line ending.
+
+    Returns:
+        tuple: A tuple containing the list of appended rows, the new offset and the new last line.
+    """
+    with open(filename, "rb") as f:
+        if offset:
+            f.seek(offset - len(last_line))
+            if f.read(len(last_line)) != last_line:
+                raise ValueError(
+                    f"{filename} changed other than by appending rows since the previous run"
+                )
+        else:
+            offset = len(f.readline())  # skip first header line
+        data = f.read()
+
+    # a line still being appended is left for the next run
+    data = data[: data.rfind(b"\n") + 1]
+    lines = data.splitlines(keepends=True)
+    if lines:
+        offset, last_line = offset + len(data), lines[-1]
+    rows = [tuple(line.decode().strip().split(",")) for line in lines]
+    return rows, offset, last_line
+
+
+def apply_delta(state, R_new, S_new):
+    """Maintain the outer join for rows appended to R and S since the previous run.
+
+    New S rows are probed only against the previously seen R rows and new R rows against the
+    full S, so every pair is joined exactly once. R rows that were dangling and now match are
+    retracted and replaced by their inner join results.
+
+    Args:
+        state (dict): The incremental join state, updated in place.
+        R_new (list): The rows appended to table R.
+        S_new (list): The rows appended to table S.
+
+    Returns:
+        list: The delta rows, each prefixed with "+" for an insertion or "-" for a retraction.
+    """
+    delta = []
+    R, R_index, S_tables = state["R"], state["R_index"], state["S_tables"]
+    dangling_tuples = state["dangling_tuples"]
+
+    for element in S_new:
+        # place the row in the partition round robin would have assigned to it
+        S_table = S_tables[state["S_count"] % len(S_tables)]
+        S_table.setdefault(hash(element), []).append(element)
+        state["S_count"] += 1
+
+        for i in R_index.get(hash(element), []):
+            if R[i][0] != element[0]:
+                continue
+            if i in dangling_tuples:
+                dangling_tuples.remove(i)
+                delta.append(("-",) + R[i] + tuple([None] * (state["S_len"] - 1)))
+            delta.append(("+",) + R[i] + element[1:])
+
+    for element in R_new:
+        i = len(R)
+        R.append(element)
+        R_index.setdefault(hash(element), []).append(i)
+
+        is_matched = False
+        for S_table in S_tables:
+            is_exist, matches = lookup(element, S_table)
+            if is_exist:
+                is_matched = True
+                delta += [("+",) + match for match in matches]
+        if not is_matched:
+            dangling_tuples.add(i)
+            delta.append(("+",) + element + tuple([None] * (state["S_len"] - 1)))
+
+    return delta
+
+
+def soja_incremental(
+    R_file_path,
+    S_file_path,
+    number_of_processor,
+    output_file_path,
+    state_file_path,
+    profile_dir=None,
+):
+    """Perform the outer join incrementally, only joining rows appended since the previous run.
+
+    The first run, without a state file, is a regular parallel SOJA run whose workers also write their
+    S hash tables and dangling tuples to build the state from. Later runs only read the bytes appended to
+    both files and apply the delta in this process.
+
+    Args:
+        R_file_path (str): The path to the CSV file of table R.
+        S_file_path (str): The path to the CSV file of table S.
+        number_of_processor (int): The number of processors used by the first run.
+        output_file_path (str): The file path of the output file where the join or its delta is written.
+        state_file_path (str): The file path where the state is kept between runs.
+        profile_dir (str): The directory where the profile samples are written, None to disable profiling.
+
+    Returns:
+        tuple: A tuple containing the elapsed time (in seconds) and the total memory used (in bytes).
+    """
+    if not os.path.exists(state_file_path):
+        R, R_offset, R_last_line = read_appended_csv(R_file_path, 0, b"")
+        S, S_offset, S_last_line = read_appended_csv(S_file_path, 0, b"")
+
+        # workers write their partition state to files, so it is not traced when it reaches this process
+        elapsed_time, total_memory = soja(
+            R, S, number_of_processor, output_file_path, profile_dir, state_file_path
+        )
+        tracemalloc.stop()
+
+        start_time = time.perf_counter()
+        state = build_state(R, S, number_of_processor, state_file_path)
+        state.update(
+            R_offset=R_offset,
+            R_last_line=R_last_line,
+            S_offset=S_offset,
+            S_last_line=S_last_line,
+        )
+        save_state(state, state_file_path)
+        elapsed_time += time.perf_counter() - start_time
+
+        return elapsed_time, total_memory
+
+    # the delta is applied in this process, so it is the only one sampled
+    sampler = Sampler()
+    if profile_dir:
+        prepare_profile_dir(profile_dir)
+        sampler.start()
+
+    # start timer, loading and saving the state is included as it grows with the total size of the tables
+    start_time = time.perf_counter()
+
+    with sampler.phase("load state"):
+        state = load_state(state_file_path)
+
+    # start memory profiler once the state is loaded, tracing every object of it would dominate the run
+    tracemalloc.start()
+
+    with sampler.phase("read"):
+        R_new, state["R_offset"], state["R_last_line"] = read_appended_csv(
+            R_file_path, state["R_offset"], state["R_last_line"]
+        )
+        S_new, state["S_offset"], state["S_last_line"] = read_appended_csv(
+            S_file_path, state["S_offset"], state["S_last_line"]
+        )
+
+    with sampler.phase("probe"):
+        delta = apply_delta(state, R_new, S_new)
+
+    with sampler.phase("write"):
+        with open(output_file_path, "w") as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerows(delta)
+
+    with sampler.phase("save state"):
+        save_state(state, state_file_path)
+
+    elapsed_time = time.perf_counter() - start_time
+
+    snapshot = tracemalloc.take_snapshot()
+    top_stats = exclude_samplers(snapshot.statistics("lineno"))
 
     total_memory = sum(stat.size for stat in top_stats)
+    tracemalloc.stop()
+
+    if profile_dir:
+        sampler.stop()
+        sampler.dump(profile_dir, "soja-incremental")
 
     return elapsed_time, total_memory
 
@@ -256,10 +569,39 @@ if __name__ == "__main__":
         required=False,
         default="output-soja.csv",
     )
+    parser.add_argument(
+        "--state-file",
+        help="Path to the state kept between runs, enables incremental mode writing only the delta to the output file after the first run",
+        required=False,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile each worker process and write the merged report and collapsed stacks to this directory",
+        required=False,
+        nargs="?",
+        const="profile-soja",
+        metavar="DIR",
+    )
     args = parser.parse_args()
-    R, S = read_csv(args.R_file), read_csv(args.S_file)
 
-    elapsed_time, memory_usage = soja(R, S, args.concurrency_count, args.output_file)
+    if args.state_file:
+        elapsed_time, memory_usage = soja_incremental(
+            args.R_file,
+            args.S_file,
+            args.concurrency_count,
+            args.output_file,
+            args.state_file,
+            args.profile,
+        )
+    else:
+        R, S = read_csv(args.R_file), read_csv(args.S_file)
+        elapsed_time, memory_usage = soja(
+            R, S, args.concurrency_count, args.output_file, args.profile
+        )
     print(f"Memory usage: {memory_usage / 1024 / 1024:.2f} MB")
     print(f"Execution time: {elapsed_time:.2f} seconds")
+    if args.profile:
+        report_path, collapsed_path = merge_profiles(args.profile)
+        print(f"Profile report: {report_path}")
+        print(f"Collapsed stacks: {collapsed_path}")
     print("-------------------------")